@@ -1,25 +1,31 @@
 import asyncio
-import base64
-import requests
-import json
+import concurrent.futures
+import itertools
+import threading
+from functools import lru_cache
 
 # Remove unused imports
-# import os
 # import sys
 # from io import BytesIO
 
-import nacl.secret
-import nacl.public
-import nacl.encoding
-import nacl.utils
-
-import base58
-import ed25519
-
-from py_near.account import Account
-
+# py_near is imported where it is used, so turns that never touch the
+# chain don't pay for importing it
 
 from nearai.agents.environment import Environment
+from utils import (
+    AiUtils,
+    HTTP_SESSION,
+    IMAGE_FORMATS,
+    STREAM_CHUNK_SIZE,
+    VISION_MODEL,
+    b64encode_chunks,
+    get_ipfs_cid,
+    get_public_key,
+    get_url_extension,
+    get_vision_messages,
+    retrieve_from_ipfs,
+    sniff_image_format,
+)
 
 # Get the environment from globals
 env = globals().get("env")
@@ -29,212 +35,83 @@ signer_private_key = env.env_vars.get("signer_private_key", None)
 # Get encryption key from environment (if needed)
 ENCRYPTION_KEY = env.env_vars.get("encryption_key", None)
 
-def describe_image(url: str):
+
+def describe_image(image):
     """
-    Analyzes an image from a URL and returns a text description of what is in the picture.
+    Analyzes an image and returns a text description of what is in the picture.
 
     Args:
-        url: A string URL pointing to an image
+        image: A string URL pointing to an image, or the raw image data as bytes
 
     Returns:
         A text description of the image content
     """
     try:
-        # Download the image from the URL
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-
-        # Get the image data
-        image_data = response.content
-        
-        # Encode the image as base64
-        image_base64 = base64.b64encode(image_data).decode("utf-8")
-        
-        # Determine image format from URL
-        if url.lower().endswith(".png"):
-            image_format = "png"
-        elif url.lower().endswith(".jpg") or url.lower().endswith(".jpeg"):
-            image_format = "jpeg"
-        elif url.lower().endswith(".gif"):
-            image_format = "gif"
-        elif url.lower().endswith(".webp"):
-            image_format = "webp"
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            # Raw image data, encode it as is
+            chunks = iter((image,))
+            default_format = "jpeg"
         else:
-            # Default to png if format can't be determined
-            image_format = "png"
-        
-        # Create the message with the image
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{image_format};base64,{image_base64}"
-                        },
-                    },
-                    {
-                        "type": "text",
-                        "text": "Describe this image in detail. What do you see? "
-                        "Include all relevant details about objects, people, "
-                        "settings, colors, and any text visible in the image.",
-                    },
-                ],
-            }
-        ]
+            # Let the vision model fetch the image itself, skipping the download
+            # and the base64 round-trip
+            try:
+                return env.completion(get_vision_messages(image), model=VISION_MODEL)
+            except Exception:
+                pass  # The model could not fetch the URL, send the image inline
+
+            cid = get_ipfs_cid(image)
+            if cid:
+                # IPFS content never changes, so take it from the CID cache
+                chunks = iter((retrieve_from_ipfs(cid),))
+            else:
+                # Stream the image from the URL
+                response = HTTP_SESSION.get(image, timeout=10, stream=True)
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+            default_format = IMAGE_FORMATS.get(get_url_extension(image), "png")
+        first_chunk = next(chunks, b"")
+
+        # Determine image format from its magic bytes, then from the URL path
+        image_format = sniff_image_format(first_chunk, default_format)
+
+        # Encode the image as base64 right behind the data URL prefix
+        data_url = bytearray(f"data:image/{image_format};base64,".encode("ascii"))
+        b64encode_chunks(itertools.chain((first_chunk,), chunks), data_url)
         
         # Use the vision model to analyze the image
-        model = "phi-3-vision-128k-instruct"
-        response = env.completion(messages, model=model)
+        response = env.completion(get_vision_messages(data_url.decode("ascii")), model=VISION_MODEL)
         return response
     except Exception as e:
         return f"Error analyzing image: {str(e)}"
 
-def describe_image(image_data: bytes):
-    """
-    Analyzes an image from a URL and returns a text description of what is in the picture.
-
-    Args:
-        image_data: The raw image data as bytes
 
-    Returns:
-        A text description of the image content
-    """
-    try:
-        # Encode the image as base64
-        image_base64 = base64.b64encode(image_data).decode("utf-8")
-        
-        image_format = "jpg"
-        
-        # Create the message with the image
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{image_format};base64,{image_base64}"
-                        },
-                    },
-                    {
-                        "type": "text",
-                        "text": "Describe this image in detail. What do you see? "
-                        "Include all relevant details about objects, people, "
-                        "settings, colors, and any text visible in the image.",
-                    },
-                ],
-            }
-        ]
-        
-        # Use the vision model to analyze the image
-        model = "phi-3-vision-128k-instruct"
-        response = env.completion(messages, model=model)
-        return response
-    except Exception as e:
-        return f"Error analyzing image: {str(e)}"
+# Started account shared across verify_task calls and the loop it was started
+# on, see get_account(). Its client is bound to that loop, so a call on any
+# other loop starts a new account in its place
+signer_account = None
+signer_account_loop = None
 
 
-def retrieve_from_ipfs(cid: str):
+async def get_account():
     """
-    Retrieve a file from IPFS by CID
-
-    Args:
-        cid: The CID of the file to retrieve
+    Returns the signer's NEAR account, creating and starting it on first use
+    on the running event loop
 
     Returns:
-        The file data as bytes
+        The started py_near Account
     """
-    try:
-        # Construct the IPFS gateway URL
-        gateway_url = f"https://{cid}.ipfs.w3s.link"
-        
-        # Fetch the file
-        response = requests.get(gateway_url, timeout=10)
-
-        if not response.ok:
-            error_msg = (
-                f"Failed to retrieve file: {response.status_code} {response.reason}"
-            )
-            raise Exception(error_msg)
-
-        # Get the content
-        content = response.content
-        return content
-    except Exception as e:
-        raise
-
-
-def decrypt_with_nacl(encrypted_data_json):
-    """
-    Decrypt data using NaCl's Box (asymmetric encryption)
+    global signer_account, signer_account_loop
+    loop = asyncio.get_running_loop()
+    if signer_account is None or signer_account_loop is not loop:
+        from py_near.account import Account
 
-    Args:
-        encrypted_data_json: JSON string containing encrypted data
-
-    Returns:
-        Decrypted data as bytes
-    """
-    try:
-        # Parse the JSON payload
-        payload = json.loads(encrypted_data_json)
-
-        # Check if we have all required fields
-        if (
-            not payload.get("nonce")
-            or not payload.get("encryptedData")
-            or not payload.get("senderPublicKey")
-        ):
-            raise Exception(
-                "Invalid payload format - missing required fields for asymmetric decryption"
-            )
-
-        # Get the private key from environment
-        if not ENCRYPTION_KEY:
-            raise Exception("Private key not found in environment variables")
-
-        # Convert the private key from base64, removing the 'b64:' prefix if present
-        private_key_base64 = ENCRYPTION_KEY.replace('b64:', '') if ENCRYPTION_KEY.startswith('b64:') else ENCRYPTION_KEY
-        try:
-            private_key_bytes = base64.b64decode(private_key_base64)
-        except Exception as e:
-            raise Exception(f"Failed to decode private key: {str(e)}")
-
-        # Create the private key object
-        try:
-            private_key = nacl.public.PrivateKey(private_key_bytes)
-        except Exception as e:
-            raise Exception(f"Failed to create private key object: {str(e)}")
-
-        # Get the sender's public key
-        try:
-            sender_public_key_bytes = base64.b64decode(payload["senderPublicKey"])
-            sender_public_key = nacl.public.PublicKey(sender_public_key_bytes)
-        except Exception as e:
-            raise Exception(f"Failed to decode sender's public key: {str(e)}")
-
-        # Get decryption components
-        try:
-            nonce = base64.b64decode(payload["nonce"])
-            encrypted_data = base64.b64decode(payload["encryptedData"])
-        except Exception as e:
-            raise Exception(f"Failed to decode nonce or encrypted data: {str(e)}")
-
-        # Create a box for decryption
-        box = nacl.public.Box(private_key, sender_public_key)
-
-        # Decrypt the data
-        try:
-            decrypted_data = box.decrypt(encrypted_data, nonce=nonce)
-        except Exception as e:
-            raise Exception(f"Decryption failed: {str(e)}")
-
-        return decrypted_data
+        acc = Account(account_id=signer_account_id, private_key=signer_private_key, rpc_addr="https://rpc.testnet.pagoda.co")
+        await acc.startup()
+        signer_account, signer_account_loop = acc, loop
+    return signer_account
 
-    except Exception as e:
-        env.add_system_log(f"Error in decrypt_with_nacl: {str(e)}")
-        raise
+# Results of tasks found already verified, which can no longer change
+VERIFIED_TASKS = {}
 
 async def verify_task(task_id: str):
     """
@@ -246,12 +123,15 @@ async def verify_task(task_id: str):
     Returns:
         Information about the task and the evidence
     """
+    # Verified tasks are final, so answer repeats without the RPC
+    if task_id in VERIFIED_TASKS:
+        return VERIFIED_TASKS[task_id]
+
     # Get the task from the contract
     contract_id = "commchain.testnet"
     
-    # Create and initialize the account
-    acc = Account(account_id=signer_account_id, private_key=signer_private_key, rpc_addr="https://rpc.testnet.pagoda.co")
-    await acc.startup()
+    # Get the initialized account
+    acc = await get_account()
     
     # Get the task
     view_result = await acc.view_function(
@@ -271,38 +151,32 @@ async def verify_task(task_id: str):
     
     # If the task is already verified
     if result["status"] == 1:  # 1 = verified
-        return f"Task {task_id} is already verified with result: {result['result']}"
+        VERIFIED_TASKS[task_id] = f"Task {task_id} is already verified with result: {result['result']}"
+        return VERIFIED_TASKS[task_id]
     
     evidence = result["evidence"]
     
     # Extract the actual CID from our custom format
-    actual_cid = evidence.replace("storj-", "")
-    
-    # Create the IPFS URL
-    ipfs_url = f"https://{actual_cid}.ipfs.w3s.link"
-
+    actual_cid = evidence.removeprefix("storj-")
     
-    # Fetch the file
-    response = requests.get(ipfs_url, timeout=10)
+    # Fetch the file in a worker thread so the event loop stays free
+    encrypted_data = await asyncio.to_thread(retrieve_from_ipfs, actual_cid)
 
-    if not response.ok:
-        error_msg = (
-            f"Failed to retrieve file: {response.status_code} {response.reason}"
-        )
-        raise Exception(error_msg)
-
-    image_data = decrypt_with_nacl(response.content)
+    image_data = AiUtils(env, agent).decrypt_with_nacl(encrypted_data, ENCRYPTION_KEY)
     
-    description = describe_image(image_data)
+    # Run the vision model in a worker thread, so other tasks being verified
+    # keep making progress during inference
+    description = await asyncio.to_thread(describe_image, image_data)
     # Return the URL
     return (
         f"Task {task_id} found. Data: {description}"
         f"To analyze this evidence, you can use the describe_image tool with the URL."
     )
 
+@lru_cache(maxsize=4)
 def get_account_id(public_key):
     url = f"https://test.api.fastnear.com/v0/public_key/{public_key}"
-    response = requests.get(url)
+    response = HTTP_SESSION.get(url, timeout=10)
     response.raise_for_status()
     content = response.json()
     account_ids = content.get("account_ids", [])
@@ -312,19 +186,37 @@ def get_account_id(public_key):
     else:
         return None
 
-def get_public_key(extended_private_key):
-    private_key_base58 = extended_private_key.replace("ed25519:", "")
+# Event loop shared by all tool calls, so the started account and its
+# connections outlive a single call
+EVENT_LOOP = asyncio.new_event_loop()
+EVENT_LOOP_LOCK = threading.Lock()
+
 
-    decoded = base58.b58decode(private_key_base58)
-    secret_key = decoded[:32]
+def run_on_event_loop(coro):
+    with EVENT_LOOP_LOCK:
+        return EVENT_LOOP.run_until_complete(coro)
 
-    signing_key = ed25519.SigningKey(secret_key)
-    verifying_key = signing_key.get_verifying_key()
 
-    base58_public_key = base58.b58encode(verifying_key.to_bytes()).decode()
+def run_coroutine(coro):
+    """
+    Runs a coroutine to completion on the shared event loop from synchronous code
 
-    return base58_public_key
+    Args:
+        coro: The coroutine to run
+
+    Returns:
+        The result of the coroutine
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop is running in this thread, so drive the shared one here
+        return run_on_event_loop(coro)
 
+    # The host already runs a loop in this thread and loops can't nest,
+    # so drive the shared loop from a worker thread instead
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_on_event_loop, coro).result()
 
 # Add this wrapper function for verify_task
 def verify_task_sync(task_id: str):
@@ -337,8 +229,101 @@ def verify_task_sync(task_id: str):
     Returns:
         Information about the task and the evidence
     """
-    # Use asyncio.run to run the async function in a synchronous context
-    return asyncio.run(verify_task(task_id))
+    return run_coroutine(verify_task(task_id))
+
+async def verify_tasks(task_ids: str):
+    """
+    Verifies several tasks concurrently
+
+    Args:
+        task_ids: Comma-separated IDs of the tasks to verify
+
+    Returns:
+        Information about each task and its evidence
+    """
+    ids = [task_id.strip() for task_id in task_ids.split(",") if task_id.strip()]
+
+    # Start the shared account first so the tasks don't each create one
+    await get_account()
+
+    # Overlap the contract lookups and evidence downloads of all tasks
+    results = await asyncio.gather(
+        *(verify_task(task_id) for task_id in ids), return_exceptions=True
+    )
+    return "\n\n".join(
+        f"Error verifying task {task_id}: {str(result)}"
+        if isinstance(result, Exception)
+        else result
+        for task_id, result in zip(ids, results)
+    )
+
+def verify_tasks_sync(task_ids: str):
+    """
+    Synchronous wrapper for the async verify_tasks function
+
+    Args:
+        task_ids: Comma-separated IDs of the tasks to verify
+
+    Returns:
+        Information about each task and its evidence
+    """
+    return run_coroutine(verify_tasks(task_ids))
+
+# System prompt prepended to the conversation on every turn
+SYSTEM_PROMPT = """
+You are an AI assistant that can help with two main tasks:
+
+1. Task Verification:
+    - Extract evidence URLs from tasks stored on the NEAR blockchain
+    - Verify if tasks have been completed
+    - Analyze the evidence using the describe_image tool
+
+When a user sends you an image URL or asks about analyzing an image, 
+use the describe_image tool.
+
+When a user asks you to verify a task, use the verify_task tool which 
+will retrieve the task and provide the evidence URL. When a user asks you
+to verify several tasks at once, use the verify_tasks tool with all of
+their IDs so they are checked concurrently.
+
+After getting the evidence URL from verify_task, you should use the 
+describe_image tool to analyze the evidence.
+
+Examples of how you can help:
+- Describe what's in an image
+- Verify if an image contains specific content
+- Verify tasks and analyze their evidence
+- Provide detailed descriptions of task evidence
+
+Always be helpful, accurate, and respectful in your responses.
+"""
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Registry the tools were registered on and its tool definitions
+tool_registry_cache = None
+tool_definitions_cache = None
+
+
+def get_tool_definitions(tool_registry):
+    """
+    Register the agent tools and build their definitions, once per tool registry
+
+    Args:
+        tool_registry: The tool registry of the environment
+
+    Returns:
+        The tool definitions to pass to the completion
+    """
+    global tool_registry_cache, tool_definitions_cache
+
+    if tool_registry is not tool_registry_cache:
+        tool_registry.register_tool(verify_task_sync)
+        tool_registry.register_tool(verify_tasks_sync)
+        # Building the definitions inspects every tool signature
+        tool_definitions_cache = tool_registry.get_all_tool_definitions()
+        tool_registry_cache = tool_registry
+    return tool_definitions_cache
+
 
 def agent(env: Environment):
     """
@@ -349,45 +334,15 @@ def agent(env: Environment):
     """
     try:
         
-        # Register tools
+        # Register tools, once per registry
         tool_registry = env.get_tool_registry()
-        tool_registry.register_tool(verify_task_sync)
-        
-        # Get system prompt
-        system_prompt = """
-        You are an AI assistant that can help with two main tasks:
-        
-        1. Task Verification:
-            - Extract evidence URLs from tasks stored on the NEAR blockchain
-            - Verify if tasks have been completed
-            - Analyze the evidence using the describe_image tool
-        
-        When a user sends you an image URL or asks about analyzing an image, 
-        use the describe_image tool.
-        
-        When a user asks you to verify a task, use the verify_task tool which 
-        will retrieve the task and provide the evidence URL.
-        
-        After getting the evidence URL from verify_task, you should use the 
-        describe_image tool to analyze the evidence.
-        
-        Examples of how you can help:
-        - Describe what's in an image
-        - Verify if an image contains specific content
-        - Verify tasks and analyze their evidence
-        - Provide detailed descriptions of task evidence
-        
-        Always be helpful, accurate, and respectful in your responses.
-        """
+        all_tools = get_tool_definitions(tool_registry)
         
         # Get all messages
         messages = env.list_messages()
         
         # Add system prompt to the beginning
-        messages = [{"role": "system", "content": system_prompt}] + messages
-        
-        # Get tool definitions
-        all_tools = tool_registry.get_all_tool_definitions()
+        messages = [SYSTEM_MESSAGE, *messages]
         
         # Get response with tools
         env.completion_and_run_tools(messages, tools=all_tools)
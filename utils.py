@@ -1,25 +1,488 @@
+import concurrent.futures
 import enum
 import json
+import logging
+import os
 import re
-from decimal import Decimal, getcontext, ROUND_DOWN
-
-import base58
-import ed25519
+import threading
+import time
+from functools import lru_cache
+from urllib.parse import urlparse
+try:
+    from pybase64 import b64decode, b64encode
+except ImportError:  # pybase64 is optional; fall back to the stdlib codec
+    from base64 import b64decode, b64encode
+# orjson reads integers beyond 64 bits as floats, so anything that may carry
+# token amounts (HTTP responses, model replies, the state file) is parsed with
+# the stdlib json module instead of json_loads
+try:
+    from orjson import dumps as orjson_dumps, loads as json_loads
+
+    def json_dumps(obj):
+        # orjson encodes to bytes, the prompts and the state file need str
+        try:
+            return orjson_dumps(obj).decode()
+        except TypeError:
+            # orjson refuses integers beyond 64 bits, such as yoctoNEAR amounts
+            return json.dumps(obj)
+except ImportError:  # orjson is optional; fall back to the stdlib codec
+    from json import dumps as json_dumps, loads as json_loads
+
+try:
+    import based58 as base58
+except ImportError:  # based58 is optional; fall back to the pure-Python codec
+    import base58
+
+import nacl.bindings
+import nacl.public
+import nacl.signing
 import requests
+from requests.adapters import HTTPAdapter
 from nearai.agents.environment import Environment
-from py_near.account import Account
-from py_near.dapps.core import NEAR
+
+logger = logging.getLogger(__name__)
 
 STATE_FILE = "state.json"
 
+# Token price list cache, refetched once it is older than TOKENS_TTL seconds
+TOKENS_FILE = "tokens.json"
+TOKENS_TTL = 300
+
+# Shared HTTP session so repeated fetches, from fastnear lookups to IPFS
+# gateway downloads, reuse pooled keep-alive connections
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
+# Patterns parse_response() uses to dig JSON out of a model reply
+MARKDOWN_JSON_RE = re.compile(r'```json\s*(\{.*?\})\s*```', re.DOTALL)
+MARKDOWN_RE = re.compile(r'```(.*?)```', re.DOTALL)
+JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# Static part of the data prompt, only the token list after it changes
+DATA_PROMPT_HEAD = """"
+        You are an agent inside a multi-agent system that takes in a prompt from a user requesting an action to make transaction on NEAR Blocckchain. Transactions will be performed on NEAR Blockchain by another agent, you only need to collect data from the user to prepare the swap. The user is authenticated through a message signed by their NEAR account, but this part is beyond your scope. You must follow the instructions under the "INSTRUCTIONS" label. You must provide your response in the format specified under "OUTPUT_FORMAT".
+
+LIST OF AVAILABLE ACTIONS:
+- GET_USER_DATA. Collecting user data. No required data.
+- NEAR_SHOW_ACCOUNT. Show data about current account: show balances of FT (fungible tokens), NFT (non-fungible tokens), NEAR native balance, NEAR account name etc.
+- NEAR_TRANSFER. When user wants to send some `amount` of NEAR tokens to `receiver_id`. Required data: {"amount": float, "receiver_id": String}
+- NEAR_STAKE. When user wants to stake some `amount` of NEAR tokens to `receiver_id` pool. Required data: {"amount": float, "receiver_id": String}
+
+**INSTRUCTIONS**
+You have a list of available actions and details for each of them. 
+Collect data from the user to choose the requested action perform it.
+If user asks what are your available actions (or just what can you do), list descriptions of your available actions here in human-readable format and rephrase them depending on user's quote. Try to speak NOT technical.
+If you are missing data, ask user to clarify it. Keep asking user until you are sure.
+Do not re-confirm action from the user if you have all the data you need to perform it, always overwrite action if you got full corresponding instructions from the user. 
+Do not request Yes/No confirmation from the user, always ask the missing details.
+Use the same writing style as the user. If they greet you, greet them back.
+
+User's message has the highest priority. For example, if user in the message says that to want to send 3 NEAR token, but current `amount` contains other value, overwrite them with values from the latest user message.
+
+**OUTPUT_FORMAT**
+* Your output response must be a single JSON object ONLY that can be parsed by Python's "json.loads()". Any comments expect JSON will make your reply invalid.
+* The JSON may contain these fields:
+    // Message to the user
+    message: String
+    
+    // Action
+    action: String ["GET_USER_DATA", "NEAR_SHOW_ACCOUNT", "NEAR_TRANSFER"]
+
+    /// Amount for an action
+    amount: Float || null
+
+    /// Receiver id for an action
+    receiver_id: String || null
+   
+EXAMPLES OF VALID OUTPUT:
+===example 1.1===
+Input: 
+{"message": "What is your name?", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm a NEAR agent and I can help you with ... (list descriptions of your available actions)", "action": "GET_USER_DATA", "amount": 1, "receiver": null}
+===example 1.2===
+Input: 
+{"message": "How can you help me name?", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm a NEAR agent and I can help you with ... (list descriptions of your available actions)", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+===example 1.3===
+Input: 
+{"message": "Can you stake NEAR?", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "Yes, I know how to stake NEAR, nut I need additional data from you ... (list required data for a specified action here and rephrase them depending on user's quote)", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+===example 2.1===
+Input: 
+{"message": "Send NEAR to alex.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm ready to send NEAR tokens to alex.near, how much to send?", "action": "GET_USER_DATA", "amount": null, "receiver": "alex.near"}
+===example 2.2===
+Input: 
+{"message": "Send 3 NEAR", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm ready to send 3 NEAR tokens, where to send it?", "action": "GET_USER_DATA", "amount": 3, "receiver": null}
+===example 3===
+Input: 
+{"message": "Send 0.01 NEAR to alex.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm sending 0.01 NEAR to alex.near", "action": "NEAR_TRANSFER", "amount": 0.01, "receiver": "alex.near"}
+===example 4.1===
+Input: 
+{"message": "Show data about my account", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "Loading your NEAR account details...", "action": "NEAR_SHOW_ACCOUNT", "amount": null, "receiver": null}
+===example 4.2===
+Input: 
+{"message": "Show my balances", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "Loading your NEAR account details...", "action": "NEAR_SHOW_ACCOUNT", "amount": null, "receiver": null}
+===example 5.1===
+Input: 
+{"message": "Stake NEAR to alex.poolv1.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm ready to stake NEAR tokens to alex.poolv1.near, how much to stake?", "action": "GET_USER_DATA", "amount": null, "receiver": "alex.poolv1.near"}
+===example 5.2===
+Input: 
+{"message": "Stake 3 NEAR", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm ready to stake 3 NEAR tokens, where to stake it? Please send a pool address.", "action": "GET_USER_DATA", "amount": 3, "receiver": null}
+===example 6===
+Input: 
+{"message": "Stake 1.5 NEAR to alex.pool.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}
+Output:
+{"message": "I'm staking 1.5 NEAR to alex.pool.near", "action": "NEAR_STAKE", "amount": 1.5, "receiver": "alex.pool.near"}
+
+LIST OF AVAILABLE TOKENS:
+"""
+
+
+@lru_cache(maxsize=1)
+def load_private_key(encryption_key):
+    """
+    Decode the NaCl private key once per process
+
+    Args:
+        encryption_key: The base64 private key, optionally prefixed with 'b64:'
+
+    Returns:
+        The private key as a nacl.public.PrivateKey
+    """
+    # Convert the private key from base64, removing the 'b64:' prefix if present
+    private_key_base64 = encryption_key.removeprefix("b64:")
+    try:
+        private_key_bytes = b64decode(private_key_base64)
+    except Exception as e:
+        raise Exception(f"Failed to decode private key: {str(e)}")
+
+    # Create the private key object
+    try:
+        return nacl.public.PrivateKey(private_key_bytes)
+    except Exception as e:
+        raise Exception(f"Failed to create private key object: {str(e)}")
+
+
+@lru_cache(maxsize=64)
+def get_shared_key(encryption_key, sender_public_key_bytes):
+    """
+    Derive the Curve25519 shared key for a sender once and reuse it for every payload
+
+    Args:
+        encryption_key: The base64 private key, optionally prefixed with 'b64:'
+        sender_public_key_bytes: The sender's raw 32-byte public key
 
+    Returns:
+        The 32-byte shared key for crypto_box_open_afternm()
+    """
+    private_key = load_private_key(encryption_key)
+    return nacl.bindings.crypto_box_beforenm(sender_public_key_bytes, private_key.encode())
+
+
+# Balances repeat across turns and tokens, zero above all
+@lru_cache(maxsize=4096)
 def convert_from_decimals_to_string(number: float, decimals: int, round_digits: int = 6) -> str:
-    getcontext().prec = decimals + 20
-    decimal_number = Decimal(number)
-    scaled_number = decimal_number / Decimal(10) ** decimals
-    rounded_number = scaled_number.quantize(Decimal('1.' + '0' * round_digits), rounding=ROUND_DOWN)
+    # Shift the decimal point on the digits of the integer balance, truncating the fraction
+    digits = str(int(number)).rjust(decimals + 1, "0")
+    integer_part = digits[:len(digits) - decimals]
+    if not round_digits:
+        return integer_part
+
+    fraction_part = digits[len(digits) - decimals:][:round_digits].ljust(round_digits, "0")
+
+    return f"{integer_part}.{fraction_part}"
+
+
+@lru_cache(maxsize=4)
+def get_public_key(extended_private_key):
+    private_key_base58 = extended_private_key.replace("ed25519:", "")
+
+    decoded = base58.b58decode(private_key_base58.encode())
+    secret_key = decoded[:32]
+
+    # libsodium derives the public key from the seed in native code
+    signing_key = nacl.signing.SigningKey(secret_key)
+    verifying_key = signing_key.verify_key
+
+    base58_public_key = base58.b58encode(verifying_key.encode()).decode()
+
+    return base58_public_key
+
+
+@lru_cache(maxsize=4)
+def get_private_key(extended_private_key):
+    private_key_base58 = extended_private_key.replace("ed25519:", "")
+    decoded = base58.b58decode(private_key_base58.encode())
+    secret_key = decoded[:32]
+
+    return base58.b58encode(secret_key).decode()
+
 
-    return str(rounded_number)
+# Size of the chunks read from streamed downloads
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def b64encode_chunks(chunks, out=None):
+    """
+    Base64-encode an iterable of byte chunks into a single buffer
+
+    Args:
+        chunks: Iterable of bytes-like chunks, e.g. from response.iter_content()
+        out: Optional bytearray to append the encoded data to
+
+    Returns:
+        The bytearray holding the encoded data
+    """
+    if out is None:
+        out = bytearray()
+    tail = b""
+    for chunk in chunks:
+        if tail:
+            chunk = tail + chunk
+        # Only whole 3-byte groups encode without padding, carry the rest over
+        cut = len(chunk) - len(chunk) % 3
+        out += b64encode(memoryview(chunk)[:cut])
+        tail = chunk[cut:]
+    if tail:
+        out += b64encode(tail)
+    return out
+
+
+# Image formats by file extension, used to label data URLs
+IMAGE_FORMATS = {
+    ".png": "png",
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".gif": "gif",
+    ".webp": "webp",
+}
+
+
+def get_url_extension(url):
+    """
+    Returns the lowercased file extension of a URL path, ignoring any query string
+
+    Args:
+        url: The URL to inspect
+
+    Returns:
+        The extension including the leading dot, or an empty string
+    """
+    return os.path.splitext(urlparse(url).path)[1].lower()
+
+
+def sniff_image_format(data, default="png"):
+    """
+    Detects the image format from its leading magic bytes
+
+    Args:
+        data: The image data, at least its first 12 bytes
+        default: The format to return when the signature is not recognized
+
+    Returns:
+        The image format as used in data URLs
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return default
+
+
+# Host suffix of the IPFS gateway that serves task evidence
+IPFS_GATEWAY_SUFFIX = ".ipfs.w3s.link"
+
+
+def get_ipfs_cid(url):
+    """
+    Returns the CID of an IPFS gateway URL
+
+    Args:
+        url: The URL to inspect
+
+    Returns:
+        The CID, or None if the URL does not point to the IPFS gateway
+    """
+    parsed = urlparse(url)
+    hostname = parsed.hostname or ""
+    if hostname.endswith(IPFS_GATEWAY_SUFFIX) and parsed.path in ("", "/"):
+        return hostname[: -len(IPFS_GATEWAY_SUFFIX)]
+    return None
+
+
+def read_response_body(response, stop=None):
+    """
+    Reads a streamed response body into a buffer preallocated from its Content-Length
+
+    Args:
+        response: A response requested with stream=True
+        stop: Optional threading.Event, reading gives up between chunks once it is set
+
+    Returns:
+        The body as a bytes-like object
+    """
+    size = int(response.headers.get("Content-Length") or 0)
+    if not size or response.headers.get("Content-Encoding"):
+        if stop is None:
+            # Unknown or encoded length, let requests assemble the body
+            return response.content
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if stop.is_set():
+                raise Exception("Stopped reading the response body")
+            body += chunk
+        return body
+
+    body = bytearray(size)
+    with memoryview(body) as view:
+        filled = 0
+        while filled < size:
+            if stop is not None and stop.is_set():
+                raise Exception("Stopped reading the response body")
+            read = response.raw.readinto(view[filled:filled + STREAM_CHUNK_SIZE])
+            if not read:
+                break
+            filled += read
+    # Drop the unused tail if the server sent less than announced
+    del body[filled:]
+    return body
+
+
+# Gateway URL templates for IPFS content, the first one is tried alone first
+IPFS_GATEWAYS = (
+    "https://{cid}" + IPFS_GATEWAY_SUFFIX,
+    "https://ipfs.io/ipfs/{cid}",
+    "https://dweb.link/ipfs/{cid}",
+)
+
+# Seconds to wait on the first gateway before racing the others
+IPFS_HEDGE_DELAY = 1.0
+
+# Threads for gateway requests, bounding how many fetches run at once
+IPFS_FETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=6)
+
+
+def fetch_from_gateway(gateway_url, stop=None):
+    """
+    Fetch a file from a single IPFS gateway
+
+    Args:
+        gateway_url: The gateway URL of the file
+        stop: Optional threading.Event, the download is abandoned once it is set
+
+    Returns:
+        The file data as a bytes-like object
+    """
+    with HTTP_SESSION.get(gateway_url, timeout=10, stream=True) as response:
+        if not response.ok:
+            error_msg = (
+                f"Failed to retrieve file: {response.status_code} {response.reason}"
+            )
+            raise Exception(error_msg)
+
+        # Read the content straight into a single buffer
+        return read_response_body(response, stop)
+
+
+# Whole evidence files are cached, so keep only a handful of them
+@lru_cache(maxsize=8)
+def retrieve_from_ipfs(cid: str):
+    """
+    Retrieve a file from IPFS by CID, cached since a CID always maps to the same bytes
+
+    Args:
+        cid: The CID of the file to retrieve
+
+    Returns:
+        The file data as a bytes-like object
+    """
+    gateway_urls = [gateway.format(cid=cid) for gateway in IPFS_GATEWAYS]
+
+    # Ask the primary gateway first, and hedge against its slow tail by
+    # racing the other gateways if it is slow or fails
+    stop = threading.Event()
+    futures = [IPFS_FETCH_POOL.submit(fetch_from_gateway, gateway_urls[0], stop)]
+    done, _ = concurrent.futures.wait(futures, timeout=IPFS_HEDGE_DELAY)
+    if not done or futures[0].exception() is not None:
+        futures += [
+            IPFS_FETCH_POOL.submit(fetch_from_gateway, gateway_url, stop)
+            for gateway_url in gateway_urls[1:]
+        ]
+
+    # Keep the first successful response
+    error = None
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            content = future.result()
+        except Exception as e:
+            error = e
+            continue
+        # cancel() only drops fetches that haven't started, the stop event
+        # makes the running ones give up at their next chunk
+        stop.set()
+        for other in futures:
+            other.cancel()
+        return content
+    raise error
+
+
+# Vision model used to describe images
+VISION_MODEL = "phi-3-vision-128k-instruct"
+
+# Text part of every vision request, shared since it never changes
+VISION_PROMPT = {
+    "type": "text",
+    "text": "Describe this image in detail. What do you see? "
+    "Include all relevant details about objects, people, "
+    "settings, colors, and any text visible in the image.",
+}
+
+
+def get_vision_messages(image_url):
+    """
+    Builds the vision model request describing a single image
+
+    Args:
+        image_url: A URL or data URL of the image
+
+    Returns:
+        The list of messages to send to the vision model
+    """
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url
+                    },
+                },
+                VISION_PROMPT,
+            ],
+        }
+    ]
 
 
 class State:
@@ -29,32 +492,49 @@ class State:
         self.receiver_id = None
 
         self.all_available_tokens = None
+        # Per-token lookups built from all_available_tokens by AiUtils.index_tokens()
+        self.token_decimals = None
+        self.token_symbols = None
 
         self.__dict__.update(entries)
+        # Cached to_json() result, dropped whenever a field is set or removed.
+        # Fields are replaced rather than mutated in place, so that is enough.
+        self.__dict__["_json"] = None
+
+    def __setattr__(self, key, value):
+        self.__dict__[key] = value
+        self.__dict__["_json"] = None
 
     def to_dict(self):
-        return {k: (v.name if isinstance(v, enum.Enum) else v) for k, v in self.__dict__.items()}
+        return {k: (v.name if isinstance(v, enum.Enum) else v) for k, v in self.__dict__.items()
+                if not k.startswith("_")}
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        if self._json is None:
+            self.__dict__["_json"] = json_dumps(self.to_dict())
+        return self._json
 
     def remove_attribute(self, key):
         if key in self.__dict__:
             del self.__dict__[key]  # Use del to remove the attribute
+            self.__dict__["_json"] = None
         else:
-            print(f"Attribute '{key}' not found in State.")
+            logger.debug("Attribute '%s' not found in State.", key)
 
 
 class AiUtils(object):
     def __init__(self, _env: Environment, _agent):
         self.env = _env
         self.agent = _agent
+        self.token_prompt_cache = (None, None)
+        # fastnear account responses by (account_id, kind), for the life of this instance
+        self.fastnear_cache = {}
 
     def get_account_id(self, public_key):
         url = f"https://test.api.fastnear.com/v0/public_key/{public_key}"
-        response = requests.get(url)
+        response = HTTP_SESSION.get(url, timeout=10)
         response.raise_for_status()
-        content = response.json()
+        content = json.loads(response.content)
         account_ids = content.get("account_ids", [])
 
         if len(account_ids):
@@ -63,45 +543,108 @@ class AiUtils(object):
             return None
 
     def get_public_key(self, extended_private_key):
-        private_key_base58 = extended_private_key.replace("ed25519:", "")
-
-        decoded = base58.b58decode(private_key_base58)
-        secret_key = decoded[:32]
-
-        signing_key = ed25519.SigningKey(secret_key)
-        verifying_key = signing_key.get_verifying_key()
-
-        base58_public_key = base58.b58encode(verifying_key.to_bytes()).decode()
-
-        return base58_public_key
+        return get_public_key(extended_private_key)
 
     async def get_account_balance(self, account_id, private_key):
+        # py_near is heavy and only needed here, so import it on first use
+        from py_near.account import Account
+        from py_near.dapps.core import NEAR
+
         account = Account(account_id, private_key)
 
         return await account.get_balance() / NEAR
 
     def get_private_key(self, extended_private_key):
-        private_key_base58 = extended_private_key.replace("ed25519:", "")
-        decoded = base58.b58decode(private_key_base58)
-        secret_key = decoded[:32]
+        return get_private_key(extended_private_key)
+
+    def decrypt_with_nacl(self, encrypted_data_json, encryption_key):
+        """
+        Decrypt data using NaCl's Box (asymmetric encryption)
 
-        return base58.b58encode(secret_key).decode()
+        Args:
+            encrypted_data_json: JSON string containing encrypted data
+            encryption_key: The base64 private key, optionally prefixed with 'b64:'
+
+        Returns:
+            Decrypted data as bytes
+        """
+        try:
+            # Parse the JSON payload
+            payload = json_loads(encrypted_data_json)
+
+            # Check if we have all required fields
+            if (
+                not payload.get("nonce")
+                or not payload.get("encryptedData")
+                or not payload.get("senderPublicKey")
+            ):
+                raise Exception(
+                    "Invalid payload format - missing required fields for asymmetric decryption"
+                )
+
+            if not encryption_key:
+                raise Exception("Private key not found in environment variables")
+
+            # Get the sender's public key
+            try:
+                sender_public_key_bytes = b64decode(payload["senderPublicKey"], validate=False)
+                if len(sender_public_key_bytes) != nacl.public.PublicKey.SIZE:
+                    raise ValueError(
+                        f"The key must be exactly {nacl.public.PublicKey.SIZE} bytes long"
+                    )
+            except Exception as e:
+                raise Exception(f"Failed to decode sender's public key: {str(e)}")
+
+            # Get decryption components
+            try:
+                nonce = b64decode(payload["nonce"], validate=True)
+                encrypted_data = b64decode(payload["encryptedData"], validate=True)
+            except Exception as e:
+                raise Exception(f"Failed to decode nonce or encrypted data: {str(e)}")
+
+            # Known senders reuse their shared key, skipping the scalar multiplication
+            shared_key = get_shared_key(encryption_key, sender_public_key_bytes)
+
+            # Decrypt the data
+            try:
+                decrypted_data = nacl.bindings.crypto_box_open_afternm(
+                    encrypted_data, nonce, shared_key
+                )
+            except Exception as e:
+                raise Exception(f"Decryption failed: {str(e)}")
+
+            return decrypted_data
+
+        except Exception as e:
+            self.env.add_system_log(f"Error in decrypt_with_nacl: {str(e)}")
+            raise
+
+    def fetch_fastnear(self, account_id, kind):
+        # A turn often asks for the same account data more than once, fetch it once
+        key = (account_id, kind)
+        content = self.fastnear_cache.get(key)
+        if content is None:
+            url = f"https://test.api.fastnear.com/v1/account/{account_id}/{kind}"
+            response = HTTP_SESSION.get(url, timeout=10)
+            response.raise_for_status()
+            content = json.loads(response.content)
+            self.fastnear_cache[key] = content
+
+        return content
 
     def get_account_fts(self, state, account_id):
-        url = f"https://test.api.fastnear.com/v1/account/{account_id}/ft"
-        response = requests.get(url)
-        response.raise_for_status()
-        content = response.json()
+        content = self.fetch_fastnear(account_id, "ft")
         tokens = content.get("tokens", [])
 
-        print("tokens", tokens)
+        logger.debug("tokens %s", tokens)
 
-        if len((state.all_available_tokens or [])) == 0:
+        if len((state.all_available_tokens or [])) == 0 or state.token_decimals is None:
             self.get_all_tokens(state)
 
+        # Tokens missing from the price list have unknown decimals and stay unscaled
+        token_decimals_by_id = state.token_decimals or {}
         for token in tokens:
-            token_contract_id = token["contract_id"]
-            token_decimals = state.all_available_tokens[token_contract_id]["decimal"] or 0
+            token_decimals = token_decimals_by_id.get(token["contract_id"], 0)
             token_balance_full = token["balance"] or 0
             if token_decimals and token_balance_full:
                 token["balance_hr"] = convert_from_decimals_to_string(token_balance_full, token_decimals)
@@ -110,14 +653,15 @@ class AiUtils(object):
 
     def format_tokens_as_markdown(self, state, tokens):
         markdown_list = []
+        append = markdown_list.append
 
+        token_symbols = state.token_symbols or {}
         for token in tokens:
-            token_contract_id = token["contract_id"]
-            token_symbol = state.all_available_tokens[token_contract_id]["symbol"] or ""
-            balance_hr = token["balance_hr"] or ""
+            token_symbol = token_symbols.get(token["contract_id"], "")
+            balance_hr = token.get("balance_hr") or ""
 
             if token_symbol and balance_hr:
-                markdown_list.append(f"- {token_symbol}: {balance_hr}\n")
+                append(f"- {token_symbol}: {balance_hr}\n")
 
         if markdown_list:
             markdown_list_str = "\n**List of FT tokens:**\n" + "".join(markdown_list)
@@ -127,23 +671,19 @@ class AiUtils(object):
         return markdown_list_str
 
     def get_account_nfts(self, state, account_id):
-        url = f"https://test.api.fastnear.com/v1/account/{account_id}/nft"
-        response = requests.get(url)
-        response.raise_for_status()
-        content = response.json()
+        content = self.fetch_fastnear(account_id, "nft")
         tokens = content.get("tokens", [])
 
-        print("nfts", tokens)
+        logger.debug("nfts %s", tokens)
 
         return tokens
 
     def format_nfts_as_markdown(self, state, nfts):
-        markdown_list = []
-
-        for nft in nfts:
-            nft_contract_id = nfts["contract_id"]
-            if nft_contract_id:
-                markdown_list.append(f"- [{nft_contract_id}](https://nearblocks.io/address/{nft_contract_id})\n")
+        markdown_list = [
+            f"- [{nft_contract_id}](https://nearblocks.io/address/{nft_contract_id})\n"
+            for nft_contract_id in (nft.get("contract_id") for nft in nfts)
+            if nft_contract_id
+        ]
 
         if markdown_list:
             markdown_list_str = "\n**List of NFTs:**\n" + "".join(markdown_list)
@@ -153,23 +693,19 @@ class AiUtils(object):
         return markdown_list_str
 
     def get_account_staking_pools(self, state, account_id):
-        url = f"https://test.api.fastnear.com/v1/account/{account_id}/staking"
-        response = requests.get(url)
-        response.raise_for_status()
-        content = response.json()
+        content = self.fetch_fastnear(account_id, "staking")
         pools = content.get("pools", [])
 
-        print("staking_pools", pools)
+        logger.debug("staking_pools %s", pools)
 
         return pools
 
     def format_pools_as_markdown(self, state, pools):
-        markdown_list = []
-
-        for pool in pools:
-            pool_id = pool["pool_id"]
-            if pool_id:
-                markdown_list.append(f"- [{pool_id}](https://nearblocks.io/address/{pool_id})\n")
+        markdown_list = [
+            f"- [{pool_id}](https://nearblocks.io/address/{pool_id})\n"
+            for pool_id in (pool.get("pool_id") for pool in pools)
+            if pool_id
+        ]
 
         if markdown_list:
             markdown_list_str = "\n**List of staking pools:**\n" + "".join(markdown_list)
@@ -184,7 +720,7 @@ class AiUtils(object):
         user_message = {"message": f"{last_message}\n{reminder}", "amount": state.amount,
                         "receiver_id": state.receiver_id}
 
-        return {"role": "user", "content": json.dumps(user_message)}
+        return {"role": "user", "content": json_dumps(user_message)}
 
     def get_messages(self, state):
         system_prompt = self.get_data_prompt(state)
@@ -195,71 +731,115 @@ class AiUtils(object):
 
         messages = [{"role": "system", "content": system_prompt}] + list_messages
 
-        print("PROMPT messages:", messages)
+        logger.debug("PROMPT messages: %s", messages)
 
         return messages
 
     def fetch_url(self, url):
         try:
-            response = requests.get(url)
+            response = HTTP_SESSION.get(url, timeout=10)
             response.raise_for_status()
 
-            data = response.json()
+            data = json.loads(response.content)
 
             return data
 
         except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
+            logger.error("HTTP error occurred: %s", http_err)
         except requests.exceptions.ConnectionError as conn_err:
-            print(f"Connection error occurred: {conn_err}")
+            logger.error("Connection error occurred: %s", conn_err)
         except requests.exceptions.Timeout as timeout_err:
-            print(f"Timeout error occurred: {timeout_err}")
+            logger.error("Timeout error occurred: %s", timeout_err)
         except requests.exceptions.RequestException as req_err:
-            print(f"An error occurred: {req_err}")
+            logger.error("An error occurred: %s", req_err)
         except json.JSONDecodeError as json_err:
-            print(f"JSON decode error: {json_err}")
+            logger.error("JSON decode error: %s", json_err)
 
     def get_all_tokens(self, state: State):
+        if not state.all_available_tokens:
+            # save_state() drops the list, so a fresh run takes it from the file cache
+            state.all_available_tokens = self.get_cached_tokens()
+
         if not state.all_available_tokens:
             # Check if there's a testnet version of this API
             state.all_available_tokens = self.fetch_url("https://api.ref.finance/list-token-price")
             # If there is a testnet version, use something like:
             # state.all_available_tokens = self.fetch_url("https://testnet-api.ref.finance/list-token-price")
+            if state.all_available_tokens:
+                self.save_cached_tokens(state.all_available_tokens)
+            state.token_decimals = None  # Index the new list below
+
+        if state.token_decimals is None:
+            self.index_tokens(state)
 
         return state.all_available_tokens
 
-    def parse_response(self, response):
+    def index_tokens(self, state: State):
+        # The balance loops only need two fields per token, keep them in flat lookups
+        all_available_tokens = state.all_available_tokens or {}
+        state.token_decimals = {
+            contract_id: int(token_info.get("decimal") or 0)
+            for contract_id, token_info in all_available_tokens.items()
+        }
+        state.token_symbols = {
+            contract_id: token_info.get("symbol") or ""
+            for contract_id, token_info in all_available_tokens.items()
+        }
+
+    def get_cached_tokens(self):
+        all_files = self.env.list_files(self.env.get_agent_temp_path())
+        if TOKENS_FILE not in all_files:
+            return None
+
+        # An empty, corrupt or unexpected cache file just means fetching the list again
         try:
-            print("Parsing response", response)
-            parsed_response = json.loads(response)
-            return parsed_response
+            cached = json_loads(self.env.read_file(TOKENS_FILE))
+            if time.time() - cached.get("fetched_at", 0) > TOKENS_TTL:
+                return None
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            return None
+
+        return cached.get("tokens")
 
-        except Exception as err:
-            markdown_json_match = re.match(r'```json\s*(\{.*?\})\s*```', response, re.DOTALL)
-            if markdown_json_match:
-                response = markdown_json_match.group(1)
+    def save_cached_tokens(self, tokens):
+        self.env.write_file(TOKENS_FILE, json_dumps({"fetched_at": time.time(), "tokens": tokens}))
 
+    def parse_response(self, response):
+        logger.debug("Parsing response %s", response)
+        # Only a reply that looks like a bare object is worth parsing as is,
+        # anything wrapped in markdown or prose goes straight to extraction
+        stripped_response = response.strip()
+        if stripped_response[:1] == "{" and stripped_response[-1:] == "}":
+            try:
+                return json.loads(stripped_response)
+            except json.JSONDecodeError:
+                pass
+
+        markdown_json_match = MARKDOWN_JSON_RE.match(response)
+        if markdown_json_match:
+            response = markdown_json_match.group(1)
+
+        else:
+            markdown_match = MARKDOWN_RE.search(response)
+            if markdown_match:
+                response = markdown_match.group(1).replace('\n', '').strip()
             else:
-                markdown_match = re.search(r'```(.*?)```', response, re.DOTALL)
-                if markdown_match:
-                    response = markdown_match.group(1).replace('\n', '').strip()
-                else:
-                    json_match = re.search(r'\{.*\}', response, re.DOTALL)
-                    if json_match:
-                        response = json_match.group(0).replace('\n', '').strip()
+                json_match = JSON_OBJECT_RE.search(response)
+                if json_match:
+                    response = json_match.group(0).replace('\n', '').strip()
+        try:
+            logger.debug("Parsing response %s", response)
+            parsed_response = json.loads(response)
+            return parsed_response
+        except json.JSONDecodeError:
             try:
-                print("Parsing response", response)
+                response = response.replace(";", "")
+                logger.debug("Parsing response %s", response)
                 parsed_response = json.loads(response)
                 return parsed_response
             except json.JSONDecodeError:
-                try:
-                    response = response.replace(";", "")
-                    print("Parsing response", response)
-                    parsed_response = json.loads(response)
-                    return parsed_response
-                except json.JSONDecodeError:
-                    print(f"JSON decode error: {response}")
-                    return {"message": "JSON decode error"}
+                logger.warning("JSON decode error: %s", response)
+                return {"message": "JSON decode error"}
 
     def get_state(self):
         all_files = self.env.list_files(self.env.get_agent_temp_path())
@@ -275,116 +855,29 @@ class AiUtils(object):
 
     def save_state(self, state):
         state.remove_attribute('all_available_tokens')
-        print("Saving state", state.to_json())
-        self.env.write_file(STATE_FILE, state.to_json())
+        state.remove_attribute('token_decimals')
+        state.remove_attribute('token_symbols')
+        state_json = state.to_json()
+        logger.debug("Saving state %s", state_json)
+        self.env.write_file(STATE_FILE, state_json)
 
     def get_list_token_prompt(self, state):
+        tokens = self.get_all_tokens(state)
+        cached_tokens, cached_prompt = self.token_prompt_cache
+        if cached_prompt is not None and tokens is cached_tokens:
+            return cached_prompt
+
         prompt = f"""Below you will find  a list of all available tokens. Format of every entry: 
         NEAR_CONTRACT_ID:{{"price":PRICE_IN_USD_STRING,"symbol":"TOKEN_TICKER","decimal":NUMBER}}
 
 
-        {self.get_all_tokens(state)}
+        {tokens}
 
         """
+        # Holding on to the token list keeps its identity valid as the cache key
+        self.token_prompt_cache = (tokens, prompt)
 
         return prompt
 
     def get_data_prompt(self, state):
-        prompt = f""""
-        You are an agent inside a multi-agent system that takes in a prompt from a user requesting an action to make transaction on NEAR Blocckchain. Transactions will be performed on NEAR Blockchain by another agent, you only need to collect data from the user to prepare the swap. The user is authenticated through a message signed by their NEAR account, but this part is beyond your scope. You must follow the instructions under the "INSTRUCTIONS" label. You must provide your response in the format specified under "OUTPUT_FORMAT".
-
-LIST OF AVAILABLE ACTIONS:
-- GET_USER_DATA. Collecting user data. No required data.
-- NEAR_SHOW_ACCOUNT. Show data about current account: show balances of FT (fungible tokens), NFT (non-fungible tokens), NEAR native balance, NEAR account name etc.
-- NEAR_TRANSFER. When user wants to send some `amount` of NEAR tokens to `receiver_id`. Required data: {{"amount": float, "receiver_id": String}}
-- NEAR_STAKE. When user wants to stake some `amount` of NEAR tokens to `receiver_id` pool. Required data: {{"amount": float, "receiver_id": String}}
-
-**INSTRUCTIONS**
-You have a list of available actions and details for each of them. 
-Collect data from the user to choose the requested action perform it.
-If user asks what are your available actions (or just what can you do), list descriptions of your available actions here in human-readable format and rephrase them depending on user's quote. Try to speak NOT technical.
-If you are missing data, ask user to clarify it. Keep asking user until you are sure.
-Do not re-confirm action from the user if you have all the data you need to perform it, always overwrite action if you got full corresponding instructions from the user. 
-Do not request Yes/No confirmation from the user, always ask the missing details.
-Use the same writing style as the user. If they greet you, greet them back.
-
-User's message has the highest priority. For example, if user in the message says that to want to send 3 NEAR token, but current `amount` contains other value, overwrite them with values from the latest user message.
-
-**OUTPUT_FORMAT**
-* Your output response must be a single JSON object ONLY that can be parsed by Python's "json.loads()". Any comments expect JSON will make your reply invalid.
-* The JSON may contain these fields:
-    // Message to the user
-    message: String
-    
-    // Action
-    action: String ["GET_USER_DATA", "NEAR_SHOW_ACCOUNT", "NEAR_TRANSFER"]
-
-    /// Amount for an action
-    amount: Float || null
-
-    /// Receiver id for an action
-    receiver_id: String || null
-   
-EXAMPLES OF VALID OUTPUT:
-===example 1.1===
-Input: 
-{{"message": "What is your name?", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm a NEAR agent and I can help you with ... (list descriptions of your available actions)", "action": "GET_USER_DATA", "amount": 1, "receiver": null}}
-===example 1.2===
-Input: 
-{{"message": "How can you help me name?", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm a NEAR agent and I can help you with ... (list descriptions of your available actions)", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-===example 1.3===
-Input: 
-{{"message": "Can you stake NEAR?", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "Yes, I know how to stake NEAR, nut I need additional data from you ... (list required data for a specified action here and rephrase them depending on user's quote)", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-===example 2.1===
-Input: 
-{{"message": "Send NEAR to alex.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm ready to send NEAR tokens to alex.near, how much to send?", "action": "GET_USER_DATA", "amount": null, "receiver": "alex.near"}}
-===example 2.2===
-Input: 
-{{"message": "Send 3 NEAR", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm ready to send 3 NEAR tokens, where to send it?", "action": "GET_USER_DATA", "amount": 3, "receiver": null}}
-===example 3===
-Input: 
-{{"message": "Send 0.01 NEAR to alex.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm sending 0.01 NEAR to alex.near", "action": "NEAR_TRANSFER", "amount": 0.01, "receiver": "alex.near"}}
-===example 4.1===
-Input: 
-{{"message": "Show data about my account", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "Loading your NEAR account details...", "action": "NEAR_SHOW_ACCOUNT", "amount": null, "receiver": null}}
-===example 4.2===
-Input: 
-{{"message": "Show my balances", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "Loading your NEAR account details...", "action": "NEAR_SHOW_ACCOUNT", "amount": null, "receiver": null}}
-===example 5.1===
-Input: 
-{{"message": "Stake NEAR to alex.poolv1.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm ready to stake NEAR tokens to alex.poolv1.near, how much to stake?", "action": "GET_USER_DATA", "amount": null, "receiver": "alex.poolv1.near"}}
-===example 5.2===
-Input: 
-{{"message": "Stake 3 NEAR", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm ready to stake 3 NEAR tokens, where to stake it? Please send a pool address.", "action": "GET_USER_DATA", "amount": 3, "receiver": null}}
-===example 6===
-Input: 
-{{"message": "Stake 1.5 NEAR to alex.pool.near", "action": "GET_USER_DATA", "amount": null, "receiver": null}}
-Output:
-{{"message": "I'm staking 1.5 NEAR to alex.pool.near", "action": "NEAR_STAKE", "amount": 1.5, "receiver": "alex.pool.near"}}
-
-LIST OF AVAILABLE TOKENS:
-{self.get_list_token_prompt(state)}
-
-"""
-
-        return prompt
+        return DATA_PROMPT_HEAD + self.get_list_token_prompt(state) + "\n\n"